@@ -16,21 +16,48 @@
 
 from __future__ import print_function
 
+import hashlib
+import os
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import numpy as np
 
+import tensorflow as tf
 from keras import backend
-from keras.models import Model
 from keras.applications.vgg16 import VGG16
 
-from scipy.optimize import fmin_l_bfgs_b
+from scipy.optimize import minimize
+from scipy.linalg.blas import ssyrk
 #from scipy.misc import imsave
 
+# <markdowncell>
+# We turn on TensorFlow's XLA JIT compiler for the session Keras uses. It fuses the chains of convolutions, activations and elementwise loss operations into a handful of kernels, which cuts down on launch overhead and on traffic through intermediate buffers at every optimisation step.
+
+# <codecell>
+
+config = tf.ConfigProto()
+config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+backend.set_session(tf.Session(config=config))
+
 # <markdowncell>
 # ## Load and preprocess the content and style images
 # 
 # Our first task is to load the content and style images. Note that the content image we're working with is not particularly high quality, but the output we'll arrive at the end of this process still looks really good.
+# 
+# We convert these images into a form suitable for numerical processing. In particular, we add another dimension (beyond the classic height x width x 3 dimensions), because the network works on batches of images.
+# 
+# Before we proceed much further, we need to massage this input data to match what was done in [Simonyan and Zisserman (2015)](https://arxiv.org/abs/1409.1556), the paper that introduces the *VGG Network* model that we're going to use shortly.
+# 
+# For this, we need to perform two transformations:
+# 
+# 1. Subtract the mean RGB value (computed previously on the [ImageNet training set](http://image-net.org) and easily obtainable from Google searches) from each pixel.
+# 2. Flip the ordering of the multi-dimensional array from *RGB* to *BGR* (the ordering used in the paper).
+# 
+# The mean is broadcast over all pixels in a single subtraction, and the flip is just a view on the result. We also define the inverse transformation, which turns such an array back into an image.
+# 
+# Decoding and resizing the images takes a noticeable fraction of a second each, and when you're experimenting you'll rerun this a lot with the same images. So the fully preprocessed arrays are cached on disk in `.cache/`, keyed on the image file (and when it was last modified), the target size and the preprocessing, and an image is only decoded when it isn't in the cache yet. The images shown below are reconstructed from these arrays. Delete that directory whenever you want to start afresh.
 
 # <codecell>
 
@@ -38,9 +65,39 @@ from scipy.optimize import fmin_l_bfgs_b
 height = 512
 width = 512
 
+image_mean = np.array([103.939, 116.779, 123.68], dtype='float32')
+cache_dir = '.cache'
+
+def preprocess(image_array):
+    return (image_array - image_mean)[:, :, :, ::-1]
+
+def deprocess(x):
+    x = x.reshape((height, width, 3))
+    x = x[:, :, ::-1] + image_mean
+    return np.clip(np.round(x), 0, 255).astype('uint8')
+
+def load_image_array(path):
+    key = '%s|%f|%d|%d|%r|bgr' % (os.path.abspath(path), os.path.getmtime(path),
+                                  height, width, image_mean.tolist())
+    cache_path = os.path.join(cache_dir, hashlib.md5(key.encode()).hexdigest() + '.npy')
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+    image = Image.open(path).resize((height, width))
+    image_array = np.asarray(image, dtype='float32')
+    image_array = preprocess(np.expand_dims(image_array, axis=0))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.npy')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, image_array)
+    os.replace(temp_path, cache_path)
+    return image_array
+
+# <codecell>
+
 content_image_path = 'images/hugo.jpg'
-content_image = Image.open(content_image_path)
-content_image = content_image.resize((height, width))
+content_array = load_image_array(content_image_path)
+content_image = Image.fromarray(deprocess(content_array))
 content_image
 
 
@@ -48,8 +105,8 @@ content_image
 
 
 style_image_path = 'images/styles/wave.jpg'
-style_image = Image.open(style_image_path)
-style_image = style_image.resize((height, width))
+style_array = load_image_array(style_image_path)
+style_image = Image.fromarray(deprocess(style_array))
 style_image
 
 # <codecell>
@@ -62,72 +119,20 @@ style_image_path2 = 'images/styles/forest.jpg'
 #style_image_path2 = 'images/styles/starry_night.jpg'
 #style_image_path2 = 'images/styles/van_gough.jpg'
 #style_image_path2 = 'images/styles/wave.jpg'
-style_image2 = Image.open(style_image_path2)
-style_image2 = style_image2.resize((height, width))
+style_array2 = load_image_array(style_image_path2)
+style_image2 = Image.fromarray(deprocess(style_array2))
 style_image2
 
 # <markdowncell>
-# Then, we convert these images into a form suitable for numerical processing. In particular, we add another dimension (beyond the classic height x width x 3 dimensions) so that we can later concatenate the representations of these two images into a common data structure.
-
-# <codecell>
-
-
-content_array = np.asarray(content_image, dtype='float32')
-content_array = np.expand_dims(content_array, axis=0)
-print(content_array.shape)
-
-style_array = np.asarray(style_image, dtype='float32')
-style_array = np.expand_dims(style_array, axis=0)
-print(style_array.shape)
-
-style_array2 = np.asarray(style_image2, dtype='float32')
-style_array2 = np.expand_dims(style_array2, axis=0)
-print(style_array2.shape)
-
-# <markdowncell>
-# Before we proceed much further, we need to massage this input data to match what was done in [Simonyan and Zisserman (2015)](https://arxiv.org/abs/1409.1556), the paper that introduces the *VGG Network* model that we're going to use shortly.
+# Now we're ready to introduce a variable in Keras' backend (the TensorFlow graph) to store the *combination* image that retains the content of the content image while incorporating the style of the style image. It begins its life as a random collection of (valid) pixels.
 # 
-# For this, we need to perform two transformations:
-# 
-# 1. Subtract the mean RGB value (computed previously on the [ImageNet training set](http://image-net.org) and easily obtainable from Google searches) from each pixel.
-# 2. Flip the ordering of the multi-dimensional array from *RGB* to *BGR* (the ordering used in the paper).
-
-# <codecell>
-
-content_array[:, :, :, 0] -= 103.939
-content_array[:, :, :, 1] -= 116.779
-content_array[:, :, :, 2] -= 123.68
-content_array = content_array[:, :, :, ::-1]
-
-style_array[:, :, :, 0] -= 103.939
-style_array[:, :, :, 1] -= 116.779
-style_array[:, :, :, 2] -= 123.68
-style_array = style_array[:, :, :, ::-1]
-
-style_array2[:, :, :, 0] -= 103.939
-style_array2[:, :, :, 1] -= 116.779
-style_array2[:, :, :, 2] -= 123.68
-style_array2 = style_array2[:, :, :, ::-1]
-
-# <markdowncell>
-# Now we're ready to use these arrays to define variables in Keras' backend (the TensorFlow graph). We also introduce a placeholder variable to store the *combination* image that retains the content of the content image while incorporating the style of the style image.
-
-# <codecell>
-
-content_image = backend.variable(content_array)
-style_image = backend.variable(style_array)
-style_image2 = backend.variable(style_array2)
-combination_image = backend.placeholder((1, height, width, 3))
-
-# <markdowncell>
-# Finally, we concatenate all this image data into a single tensor that's suitable for processing by Keras' VGG16 model.
+# The content and style images never change during the optimisation, so we don't push them through the network at every step. Instead their features are computed once further below and baked into the graph as constants, which leaves the combination image as the only input to the model.
 
 # <codecell>
 
-input_tensor = backend.concatenate([content_image,
-                                    style_image,
-                                    combination_image,
-                                    style_image2], axis=0)
+initial_image = np.random.RandomState(42).uniform(
+    -128., 127., (1, height, width, 3)).astype('float32')
+combination_image = backend.variable(initial_image)
 
 # <markdowncell>
 # ## Reuse a model pre-trained for image classification to define loss functions
@@ -141,21 +146,71 @@ input_tensor = backend.concatenate([content_image,
 # ![VGG Network Architectures](images/vgg-architecture.png "VGG Network Architectures")
 # 
 # It is trivial for us to get access to this truncated model because Keras comes with a set of pretrained models, including the VGG16 model we're interested in. Note that by setting `include_top=False` in the code below, we don't include any of the fully connected layers.
+# 
+# The convolutions in VGG16 dominate the running time. On a GPU with Tensor Cores you can run the network in half precision, which halves the memory traffic and roughly doubles convolution throughput without any visible change in the output. Only the network itself runs in `float16`: its outputs are cast back to `float32` before they reach the losses, whose sums would otherwise overflow. Keep `height` and `width` multiples of 8 so that the convolutions map onto Tensor Core tiles.
+# 
+# VGG16 consists entirely of 3x3 convolutions with stride 1, the textbook case for cuDNN's Winograd algorithms, which need fewer multiplications per output. cuDNN picks them most readily for the *channels first* (NCHW) layout, so on a GPU we run the network in that layout. All the channel counts in VGG16 are multiples of 8 already. The CPU kernels only support *channels last*, so there we leave the layout alone.
+
+# <codecell>
+
+vgg_dtype = 'float32'
+#vgg_dtype = 'float16'
+
+if vgg_dtype == 'float16':
+    assert height % 8 == 0 and width % 8 == 0, 'float16 needs height and width divisible by 8'
+
+vgg_data_format = 'channels_first' if tf.test.is_gpu_available() else 'channels_last'
+
+# <markdowncell>
+# None of the losses below look deeper than `block3_conv3`, so we cut the model off there. Blocks 4 and 5 hold the wide 512-channel layers that account for the bulk of VGG16's weights and computation, and nothing we evaluate depends on them. If you experiment with deeper feature layers, move `last_layer` further down accordingly.
+# 
+# We never train the network, so rather than wiring the Keras layers (and their weight variables) into our graph, we rebuild the remaining layers from their pretrained weights as constants. This lets XLA treat the weights as part of the compiled kernels. The Keras model is only needed to get at those weights, so we load it into a graph and session of its own, which are thrown away (along with all of the model's variables, blocks 4 and 5 included) as soon as we have copied out what we need.
 
 # <codecell>
 
-model = VGG16(input_tensor=input_tensor, weights='imagenet',
-              include_top=False)
+last_layer = 'block3_conv3'
+
+with tf.Graph().as_default(), tf.Session():
+    model = VGG16(weights='imagenet', include_top=False)
+    layer_names = [layer.name for layer in model.layers]
+    vgg_layers = [(layer.name, layer.get_weights())
+                  for layer in model.layers[1:layer_names.index(last_layer) + 1]]
+del model
+
+def vgg_features(x):
+    x = backend.cast(x, vgg_dtype)
+    if vgg_data_format == 'channels_first':
+        x = backend.permute_dimensions(x, (0, 3, 1, 2))
+        tf_data_format, pool_window = 'NCHW', [1, 1, 2, 2]
+    else:
+        tf_data_format, pool_window = 'NHWC', [1, 2, 2, 1]
+    features = {}
+    for name, weights in vgg_layers:
+        if weights:
+            kernel, bias = weights
+            x = tf.nn.conv2d(x, backend.constant(kernel, dtype=vgg_dtype), [1, 1, 1, 1],
+                             'SAME', data_format=tf_data_format)
+            x = tf.nn.relu(tf.nn.bias_add(x, backend.constant(bias, dtype=vgg_dtype),
+                                          data_format=tf_data_format))
+        else:
+            x = tf.nn.max_pool(x, pool_window, pool_window, 'VALID',
+                               data_format=tf_data_format)
+        if vgg_data_format == 'channels_first':
+            features[name] = backend.cast(
+                backend.permute_dimensions(x, (0, 2, 3, 1)), 'float32')
+        else:
+            features[name] = backend.cast(x, 'float32')
+    return features
 
 # <markdowncell>
 # As is clear from the table above, the model we're working with has a lot of layers. Keras has its own names for these layers. Let's make a list of these names so that we can easily refer to individual layers later.
 
 # <codecell>
-layers = dict([(layer.name, layer.output) for layer in model.layers])
+layers = vgg_features(combination_image)
 layers
 
 # <markdowncell>
-# If you stare at the list above, you'll convince yourself that we covered all items we wanted in the table (the cells marked in green). Notice also that because we provided Keras with a concrete input tensor, the various TensorFlow tensors get well-defined shapes.
+# If you stare at the list above, you'll convince yourself that we covered all items we wanted in the table (the cells marked in green). Notice also that because we built the layers on a concrete input tensor, the various TensorFlow tensors get well-defined shapes. With the combination image as the only input, each of them has a batch dimension of 1, so the losses below can use them as they are.
 # 
 # ---
 # 
@@ -170,6 +225,19 @@ style_weight = 4.0
 style_weight2 = 4.0
 total_variation_weight = 0.5
 
+# <markdowncell>
+# To extract the (fixed) features of the content and style images, we build the truncated network once more on a placeholder and run each image through it exactly once.
+
+# <codecell>
+
+feature_input = backend.placeholder((1, height, width, 3))
+feature_outputs = vgg_features(feature_input)
+
+def precompute_features(image_array, layer_names):
+    f_features = backend.function([feature_input],
+                                  [feature_outputs[name] for name in layer_names])
+    return f_features([image_array])
+
 
 # We'll now use the feature spaces provided by specific layers of our model to define these three loss functions. We begin by initialising the total loss to 0 and adding to it in stages.
 
@@ -185,15 +253,15 @@ loss = backend.variable(0.)
 # 
 # ![Content feature reconstruction](images/content-feature.png "Content feature reconstruction")
 # 
-# The content loss is the (scaled, squared) Euclidean distance between feature representations of the content and combination images.
+# The content loss is the (scaled, squared) Euclidean distance between feature representations of the content and combination images. TensorFlow's `l2_loss` computes half the sum of squares in a single kernel, without materialising the squared differences, so we just double it.
 
 # <codecell>
 def content_loss(content, combination):
-    return backend.sum(backend.square(combination - content))
+    return 2. * tf.nn.l2_loss(combination - content)
 
-layer_features = layers['block2_conv2']
-content_image_features = layer_features[0, :, :, :]
-combination_features = layer_features[2, :, :, :]
+content_image_features = backend.constant(
+    precompute_features(content_array, ['block2_conv2'])[0])
+combination_features = layers['block2_conv2']
 
 loss += content_weight * content_loss(content_image_features,
                                       combination_features)
@@ -205,29 +273,38 @@ loss += content_weight * content_loss(content_image_features,
 # 
 # For the style loss, we first define something called a *Gram matrix*. The terms of this matrix are proportional to the covariances of corresponding sets of features, and thus captures information about which features tend to activate together. By only capturing these aggregate statistics across the image, they are blind to the specific arrangement of objects inside the image. This is what allows them to capture information about style independent of content. (This is not trivial at all, and I refer you to [a paper that attempts to explain the idea](https://arxiv.org/abs/1606.01286).)
 # 
-# The Gram matrix can be computed efficiently by reshaping the feature spaces suitably and taking an outer product.
+# The Gram matrix can be computed efficiently by reshaping the feature spaces suitably and taking an outer product. We let `matmul` handle the transpose itself, so that it is folded into the matrix multiplication rather than materialised as a separate copy of the features.
+# 
+# For the fixed style images we compute the Gram matrices in NumPy instead. Since a Gram matrix is symmetric, BLAS' `syrk` routine only needs to work out one triangle of it, half the work of a general matrix product, and we mirror that triangle to get the full matrix.
 # 
 
 # <codecell>
 
 def gram_matrix(x):
-    features = backend.batch_flatten(backend.permute_dimensions(x, (2, 0, 1)))
-    gram = backend.dot(features, backend.transpose(features))
+    features = backend.reshape(x, (-1, backend.int_shape(x)[-1]))
+    gram = tf.matmul(features, features, transpose_a=True)
     return gram
 
+def gram_matrix_np(x):
+    features = x.reshape(-1, x.shape[-1])
+    gram = ssyrk(1., features.T)
+    return np.triu(gram) + np.triu(gram, 1).T
+
 # <markdowncell>
-# The style loss is then the (scaled, squared) Frobenius norm of the difference between the Gram matrices of the style and combination images.
+# The style loss is then the (scaled, squared) Frobenius norm of the difference between the Gram matrices of the style and combination images. The scale, which folds the normalisation together with the style weight and the number of layers, only depends on Python numbers, so we work it out up front rather than in the graph. The Gram matrix of the combination image is formed once per layer and shared by both style terms.
 # 
 # Again, in the following code, I've chosen to go with the style features from layers defined in Johnson et al. (2016) rather than Gatys et al. (2015) because I find the end results more aesthetically pleasing. I encourage you to experiment with these choices to see varying results.
+# 
+# Since only the combination image changes from one step to the next, the Gram matrices of the two style images are computed just once: we extract the style features with the truncated model above, form their Gram matrices in NumPy, and hand them to the loss as constants. The Gram matrices of the second style image go into variables instead, so that we can swap in other second styles at the end without rebuilding the graph.
 
 # <codecell>
 
-def style_loss(style, combination):
-    S = gram_matrix(style)
-    C = gram_matrix(combination)
-    channels = 3
-    size = height * width
-    return backend.sum(backend.square(S - C)) / (4. * (channels ** 2) * (size ** 2))
+channels = 3
+size = height * width
+style_norm = 1. / (4. * (channels ** 2) * (size ** 2))
+
+def style_loss(S, C, scale):
+    return tf.nn.l2_loss(S - C) * (2. * scale)
 
 #feature_layers = ['block1_conv2', 'block2_conv2',
 #                  'block3_conv3', 'block4_conv3',
@@ -237,16 +314,21 @@ feature_layers = ['block1_conv2', 'block2_conv2', 'block3_conv3']
 #feature_layers = ['block1_conv2', 'block2_conv2']
 #feature_layers = ['block1_conv2']
 #feature_layers = ['block2_conv2']
-for layer_name in feature_layers:
-    layer_features = layers[layer_name]
-    style_features = layer_features[1, :, :, :]
-    style_features2 = layer_features[3, :, :, :]
-#    combination_features = layer_features[3, :, :, :]
-    combination_features = layer_features[2, :, :, :]
-    sl = style_loss(style_features, combination_features)
-    sl2 = style_loss(style_features2, combination_features)
-#    loss += (style_weight / len(feature_layers)) * sl
-    loss = loss + (style_weight / len(feature_layers)) * sl + (style_weight2 / len(feature_layers)) * sl2
+
+def style_grams(style_array):
+    return [gram_matrix_np(features)
+            for features in precompute_features(style_array, feature_layers)]
+
+style_grams1 = [backend.constant(gram) for gram in style_grams(style_array)]
+style_grams2 = [backend.variable(gram) for gram in style_grams(style_array2)]
+
+style_scale = style_weight * style_norm / len(feature_layers)
+style_scale2 = style_weight2 * style_norm / len(feature_layers)
+
+for layer_name, S, S2 in zip(feature_layers, style_grams1, style_grams2):
+    C = gram_matrix(layers[layer_name])
+#    loss += style_loss(S, C, style_scale)
+    loss = loss + style_loss(S, C, style_scale) + style_loss(S2, C, style_scale2)
 
 # <markdowncell>
 # ### The total variation loss
@@ -256,15 +338,19 @@ for layer_name in feature_layers:
 # If you were to solve the optimisation problem with only the two loss terms we've introduced so far (style and content), you'll find that the output is quite noisy. We thus add another term, called the [total variation loss](http://arxiv.org/abs/1412.0035) (a regularisation term) that encourages spatial smoothness.
 # 
 # You can experiment with reducing the `total_variation_weight` and play with the noise-level of the generated image.
+# 
+# The top-left slice shared by both differences is taken only once, and the whole expression is elementwise, so XLA can fuse it into a single pass over the image. We keep `pow(., 1.25)` rather than rewriting it as `s * sqrt(sqrt(s))`: the latter has an infinite derivative wherever neighbouring pixels are equal, which would poison the gradient with NaNs.
 
 # <codecell>
 
 def total_variation_loss(x):
-    a = backend.square(x[:, :height-1, :width-1, :] - x[:, 1:, :width-1, :])
-    b = backend.square(x[:, :height-1, :width-1, :] - x[:, :height-1, 1:, :])
+    corner = x[:, :height-1, :width-1, :]
+    a = backend.square(corner - x[:, 1:, :width-1, :])
+    b = backend.square(corner - x[:, :height-1, 1:, :])
     return backend.sum(backend.pow(a + b, 1.25))
 
-loss += total_variation_weight * total_variation_loss(combination_image)
+tv_loss = total_variation_weight * total_variation_loss(combination_image)
+loss += tv_loss
 
 # <markdowncell>
 # ## Define needed gradients and solve the optimisation problem
@@ -278,76 +364,195 @@ loss += total_variation_weight * total_variation_loss(combination_image)
 grads = backend.gradients(loss, combination_image)
 
 # <markdowncell>
-# We then introduce an `Evaluator` class that computes loss and gradients in one pass while retrieving them via two separate functions, `loss` and `grads`. This is done because `scipy.optimize` requires separate functions for loss and gradients, but computing them separately would be inefficient.
+# We then introduce a function that computes the loss and the gradients in one pass. `scipy.optimize.minimize` accepts such a function directly when called with `jac=True`, so there is no need to split it into separate `loss` and `grads` callbacks that cache each other's results.
+# 
+# The combination image lives in its variable for the whole optimisation, and both optimisers below leave their result there. To evaluate SciPy's current guess we feed it in place of the variable's value, so uploading it and computing the loss and gradients take a single run of the graph.
+# 
+# SciPy works on flat `float64` vectors. Reshaping between those and the image shape is free as long as we only create views, so the graph hands back an already flattened gradient and the only copy left per evaluation is the unavoidable cast to `float64`.
 
 # <codecell>
 
 outputs = [loss]
-outputs += grads
+outputs += [backend.reshape(grad, (-1,)) for grad in grads]
 f_outputs = backend.function([combination_image], outputs)
 
 def eval_loss_and_grads(x):
     x = x.reshape((1, height, width, 3))
     outs = f_outputs([x])
     loss_value = outs[0]
-    grad_values = outs[1].flatten().astype('float64')
+    grad_values = outs[1].astype('float64')
     return loss_value, grad_values
 
-class Evaluator(object):
-
-    def __init__(self):
-        self.loss_value = None
-        self.grads_values = None
-
-    def loss(self, x):
-        assert self.loss_value is None
-        loss_value, grad_values = eval_loss_and_grads(x)
-        self.loss_value = loss_value
-        self.grad_values = grad_values
-        return self.loss_value
+# <markdowncell>
+# Backpropagating through VGG16 means keeping every activation up to `block3_conv3` in memory at once, which becomes the limiting factor if you increase `height` and `width` (to 1024, say). We can instead cut the image into horizontal tiles and push them through the network one at a time. Each tile carries a halo of extra rows, as wide as the receptive field of the deepest layer, so that the features in its core come out exactly as they would for the whole image.
+# 
+# The content loss only compares features position by position, so its value and gradients simply add up over the tiles. The style loss is global, but the Gram matrix of the whole image is the sum of the Gram matrices of the tile cores. So we make two passes: the first one only runs forwards to add up the Gram matrices, and the second one backpropagates through each tile the gradient of the style loss with respect to its Gram matrix, which we now know. The total variation loss doesn't involve the network at all and is still computed on the whole image.
+# 
+# This trades memory for time, as every tile goes through the network twice. It only applies to L-BFGS; Adam always works on the whole image.
 
-    def grads(self, x):
-        assert self.loss_value is not None
-        grad_values = np.copy(self.grad_values)
-        self.loss_value = None
-        self.grad_values = None
-        return grad_values
+# <codecell>
 
-evaluator = Evaluator()
+tiles = 1
+#tiles = 4
+
+if tiles > 1:
+    tile_stride = 1
+    tile_halo = 0
+    for name, weights in vgg_layers:
+        tile_halo += tile_stride
+        if not weights:
+            tile_stride *= 2
+    tile_halo = -(-tile_halo // tile_stride) * tile_stride
+    tile_height = height // tiles
+    assert tile_height * tiles == height and tile_height % tile_stride == 0
+
+    tile_input = backend.placeholder((1, None, width, 3))
+    tile_top = backend.placeholder((), dtype='int32')
+    tile_row = backend.placeholder((), dtype='int32')
+    tile_features = vgg_features(tile_input)
+
+    def tile_core(features, layer_name):
+        stride = height // backend.int_shape(layers[layer_name])[1]
+        return features[:, tile_top // stride:(tile_top + tile_height) // stride]
+
+    tile_grams = [gram_matrix(tile_core(tile_features[name], name))
+                  for name in feature_layers]
+    f_tile_grams = backend.function([tile_input, tile_top], tile_grams)
+
+    content_stride = height // backend.int_shape(layers['block2_conv2'])[1]
+    content_tile = content_image_features[:, tile_row // content_stride:
+                                          (tile_row + tile_height) // content_stride]
+    tile_content_loss = content_weight * content_loss(
+        content_tile, tile_core(tile_features['block2_conv2'], 'block2_conv2'))
+    gram_grads = [backend.placeholder(backend.int_shape(C)) for C in tile_grams]
+    tile_surrogate = tile_content_loss
+    for C, dC in zip(tile_grams, gram_grads):
+        tile_surrogate += backend.sum(C * dC)
+    f_tile_grads = backend.function([tile_input, tile_top, tile_row] + gram_grads,
+                                    [tile_content_loss] +
+                                    backend.gradients(tile_surrogate, tile_input))
+
+    f_tv = backend.function([combination_image], [tv_loss] +
+                            [backend.reshape(grad, (-1,))
+                             for grad in backend.gradients(tv_loss, combination_image)])
+
+def eval_loss_and_grads_tiled(x):
+    x = x.reshape((1, height, width, 3))
+    bounds = []
+    for t in range(tiles):
+        top = t * tile_height
+        start = max(top - tile_halo, 0)
+        end = min(top + tile_height + tile_halo, height)
+        bounds.append((top, start, end))
+
+    grams = [np.zeros(backend.int_shape(C), dtype='float32') for C in tile_grams]
+    for top, start, end in bounds:
+        for G, tile_gram in zip(grams, f_tile_grams([x[:, start:end], top - start])):
+            G += tile_gram
+
+    loss_value, grad_values = f_tv([x])
+    grad_values = grad_values.reshape((1, height, width, 3)).astype('float64')
+    style_values = backend.get_session().run(style_grams1 + style_grams2)
+    dgrams = []
+    for G, S, S2 in zip(grams, style_values[:len(grams)], style_values[len(grams):]):
+        loss_value += style_scale * np.sum(np.square(G - S))
+        loss_value += style_scale2 * np.sum(np.square(G - S2))
+        dgrams.append(2. * (style_scale * (G - S) + style_scale2 * (G - S2)))
+
+    for top, start, end in bounds:
+        content_value, tile_grad = f_tile_grads([x[:, start:end], top - start, top] + dgrams)
+        loss_value += content_value
+        grad_values[:, start:end] += tile_grad
+    return loss_value, grad_values.ravel()
+
+if tiles > 1:
+    eval_loss_and_grads = eval_loss_and_grads_tiled
 
 # <markdowncell>
-# Now we're finally ready to solve our optimisation problem. This combination image begins its life as a random collection of (valid) pixels, and we use the [L-BFGS](https://en.wikipedia.org/wiki/Limited-memory_BFGS) algorithm (a quasi-Newton algorithm that's significantly quicker to converge than standard gradient descent) to iteratively improve upon it.
+# Now we're finally ready to solve our optimisation problem. Starting from the random combination image, we use the [L-BFGS](https://en.wikipedia.org/wiki/Limited-memory_BFGS) algorithm (a quasi-Newton algorithm that's significantly quicker to converge than standard gradient descent) to iteratively improve upon it.
 # 
 # We stop after 10 iterations because the output looks good to me and the loss stops reducing significantly.
+# 
+# L-BFGS runs in SciPy on the CPU, so every evaluation copies the image to the device and the gradient back. On a GPU it can pay off to switch to Adam instead: it needs more steps to converge, but each step is much cheaper because the combination image never leaves the device.
 
 # <codecell>
 
-x = np.random.uniform(0, 255, (1, height, width, 3)) - 128.
+optimizer_name = 'l-bfgs-b'
+#optimizer_name = 'adam'
 
 iterations = 20
 
-for i in range(iterations):
-    print('Start of iteration', i)
-    start_time = time.time()
-    x, min_val, info = fmin_l_bfgs_b(evaluator.loss, x.flatten(),
-                                     fprime=evaluator.grads, maxfun=20)
-    print('Current loss value:', min_val)
-    end_time = time.time()
-    print('Iteration %d completed in %ds' % (i, end_time - start_time))
+if optimizer_name == 'adam':
+    existing_variables = set(tf.global_variables())
+    train_step = tf.train.AdamOptimizer(10.).minimize(loss, var_list=[combination_image])
+    reset_optimizer = tf.variables_initializer(
+        [v for v in tf.global_variables() if v not in existing_variables])
+    session = backend.get_session()
+
+def solve(iterations):
+    if optimizer_name == 'adam':
+        session.run(reset_optimizer)
+    for i in range(iterations):
+        print('Start of iteration', i)
+        start_time = time.time()
+        if optimizer_name == 'adam':
+            for j in range(20):
+                loss_value, _ = session.run([loss, train_step])
+        else:
+            result = minimize(eval_loss_and_grads,
+                              backend.get_value(combination_image).ravel(), jac=True,
+                              method='L-BFGS-B', options={'maxfun': 20})
+            backend.set_value(combination_image, result.x.reshape((1, height, width, 3)))
+            loss_value = result.fun
+        print('Current loss value:', loss_value)
+        end_time = time.time()
+        print('Iteration %d completed in %ds' % (i, end_time - start_time))
+    return backend.get_value(combination_image)
+
+x = solve(iterations)
 
 # <markdowncell>
 # This took a while on my piddly laptop (that isn't GPU-accelerated), but here is the beautiful output from the last iteration! (Notice that we need to subject our output image to the inverse of the transformation we did to our input images before it makes sense.)
 
 # <codecell>
 
-x = x.reshape((height, width, 3))
-x = x[:, :, ::-1]
-x[:, :, 0] += 103.939
-x[:, :, 1] += 116.779
-x[:, :, 2] += 123.68
-x = np.clip(x, 0, 255).astype('uint8')
+Image.fromarray(deprocess(x))
+
+# <markdowncell>
+# ## Trying out more second styles
+# 
+# Finding a second style that goes well with the first usually takes a few attempts. Rather than rerunning everything for each candidate, we can reuse the graph: we only load the Gram matrices of the new style into their variables, reset the combination image and solve again.
+# 
+# Loading and preprocessing the next candidate happens on a background thread while the current one is being optimised, so the network never has to wait for image decoding. Each result is saved next to the notebook.
+
+# <codecell>
 
-Image.fromarray(x)
+style_image_paths2 = []
+#style_image_paths2 = ['images/styles/block.jpg',
+#                      'images/styles/gothic.jpg',
+#                      'images/styles/marilyn.jpg',
+#                      'images/styles/picasso.jpg',
+#                      'images/styles/scream.jpg',
+#                      'images/styles/starry_night.jpg',
+#                      'images/styles/van_gough.jpg']
+
+executor = ThreadPoolExecutor(max_workers=1)
+if style_image_paths2:
+    next_style_array2 = executor.submit(load_image_array, style_image_paths2[0])
+
+for k, path in enumerate(style_image_paths2):
+    style_array2 = next_style_array2.result()
+    if k + 1 < len(style_image_paths2):
+        next_style_array2 = executor.submit(load_image_array, style_image_paths2[k + 1])
+    for S2, gram in zip(style_grams2, style_grams(style_array2)):
+        backend.set_value(S2, gram)
+    backend.set_value(combination_image, initial_image)
+    print('Second style:', path)
+    x = solve(iterations)
+    output_path = 'output_%s.jpg' % os.path.splitext(os.path.basename(path))[0]
+    Image.fromarray(deprocess(x)).save(output_path)
+
+executor.shutdown()
 
 # <markdowncell>
 # ## Conclusion and further improvements